@@ -308,32 +308,163 @@
 #     uvicorn.run("eventflow_api:app", host="127.0.0.1", port=8000, reload=True)
 
 import os
+import re
+import sys
+import time
+import asyncio
+import secrets
+import functools
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ValidationError, field_validator
+from pydantic_core import from_json
+from typing import List, Dict, Optional, Any, AsyncIterator, Awaitable, Callable, Hashable, Literal, Type, TypeVar, Union
 import httpx
-import json
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent?key={GEMINI_API_KEY}"
+MODEL_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025"
+API_URL = f"{MODEL_URL}:generateContent?key={GEMINI_API_KEY}"
+STREAM_API_URL = f"{MODEL_URL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+EMBED_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/text-embedding-004:embedContent?key={GEMINI_API_KEY}"
+
+# Outgoing payloads are pre-serialized with orjson and sent as raw content
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Fail fast on connect/pool waits, allow long reads for generation, and retry
+# connection failures and 5xx responses with exponential backoff
+GEMINI_TIMEOUT = httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0)
+GEMINI_MAX_RETRIES = 2
+GEMINI_RETRY_BACKOFF = 0.5
+
+# Keep proxies (e.g. nginx) from buffering server-sent events
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# /chat reply cache: exact (history, message) hits first, then near-duplicate
+# short messages ("hi" / "hello") matched by embedding cosine similarity
+EXACT_CACHE_SIZE = 2048
+SEMANTIC_CACHE_SIZE = 256
+SEMANTIC_THRESHOLD = 0.92
+SEMANTIC_MAX_CHARS = 200
+CACHE_TTL_SECONDS = 3600
+
+# /generate-flowchart plan cache, keyed by the details the user actually gave
+FLOWCHART_CACHE_SIZE = 256
+
+# Once /chat has gathered enough details, the plan is generated speculatively
+# so /generate-flowchart can pick it up; stuck prewarms are dropped after the TTL
+PREWARM_CONCURRENCY = 4
+PREWARM_TTL_SECONDS = 300
+
+# Server-side conversations, so clients can send only the new message each turn
+SESSION_CACHE_SIZE = 1024
+SESSION_TTL_SECONDS = 3600
+
+# Long conversations: past this many (estimated) tokens, older turns are sent
+# as a single summary and only the most recent turns go to Gemini verbatim
+MAX_HISTORY_TOKENS = 6000
+COMPACTION_KEEP_RECENT = 6
+SUMMARY_CACHE_SIZE = 512
+
+# Hard bounds on what a single request sends: at most HISTORY_WINDOW messages
+# verbatim (older ones are folded into the summary) and no message text longer
+# than MAX_MESSAGE_CHARS, which is enforced on ingress so sessions and caches
+# never hold more than that per message either
+HISTORY_WINDOW = 20
+MAX_MESSAGE_CHARS = 4000
+MAX_REQUEST_BYTES = 1_000_000
+
+# Histories past either size have their CPU-bound prep (formatting, keyword
+# scan) moved to a worker thread so they don't stall the event loop; smaller
+# ones are cheaper to handle inline than the thread hop costs
+THREAD_OFFLOAD_MESSAGES = 50
+THREAD_OFFLOAD_TOKENS = 5000  # ~20k characters
+
+def truncate_text(text: str) -> str:
+    if len(text) <= MAX_MESSAGE_CHARS:
+        return text
+    return text[:MAX_MESSAGE_CHARS - 1] + "…"
+
+class ChatPart(BaseModel):
+    text: str
+
+    _cap_length = field_validator("text")(truncate_text)
+
+class ChatMessage(BaseModel):
+    # Mirrors Gemini's "contents" entries, so role is passed straight through
+    role: Literal["user", "model"]
+    parts: List[ChatPart]
+
+# Speaker names that mark a model turn in the legacy {"01_user": ..., "02_ai": ...} shape
+_LEGACY_MODEL_SPEAKERS = frozenset({"ai", "model", "assistant", "bot"})
+
+_LEGACY_KEY_NUMBER_RE = re.compile(r"\d+")
+_LEGACY_KEY_WORD_RE = re.compile(r"[a-z]+")
+
+def legacy_role(key: str) -> str:
+    # The key is split into its words; any model speaker among them marks a
+    # model turn ("02_ai" and "ai_reply_3" -> model, "user3" -> user)
+    speakers = _LEGACY_KEY_WORD_RE.findall(key.lower())
+    return "model" if not _LEGACY_MODEL_SPEAKERS.isdisjoint(speakers) else "user"
+
+def legacy_order(key: str) -> tuple[int, bool, str]:
+    # Numeric, so "user10" comes after "user2"; on a shared number ("user1",
+    # "ai1") the user's message comes first
+    number = _LEGACY_KEY_NUMBER_RE.search(key)
+    return (int(number.group()) if number else 0, legacy_role(key) == "model", key)
+
+def normalize_legacy_history(value: Any) -> Any:
+    """
+    Accept the old Dict[str, str] chat_history and convert it once on ingress.
+    """
+    if not isinstance(value, dict):
+        return value
+    return [
+        {"role": legacy_role(key), "parts": [{"text": value[key]}]}
+        for key in sorted(value, key=legacy_order)
+    ]
 
 class ChatHistoryRequest(BaseModel):
-    # NOTE: Ensure your keys are sortable (e.g., "01_user", "02_ai") or the order might get mixed up!
-    chat_history: Dict[str, str]  
+    # Oldest message first; the list is sent to Gemini in this exact order.
+    # When session_id names a live session, the stored history is used instead
+    # and chat_history can be left empty. Sessions live in one worker's memory,
+    # so an unknown/expired id with no history gets a 404: resend chat_history.
+    chat_history: List[ChatMessage] = []
     current_text: str 
+    session_id: Optional[str] = None
+
+    _cap_length = field_validator("current_text")(truncate_text)
+    _accept_legacy_history = field_validator("chat_history", mode="before")(normalize_legacy_history)
 
 class ConversationalResponse(BaseModel):
     reply_text: str 
+    session_id: Optional[str] = None
 
 class FlowchartRequest(BaseModel):
-    chat_history: Dict[str, str] 
+    chat_history: List[ChatMessage] = []
+    session_id: Optional[str] = None
+
+    _accept_legacy_history = field_validator("chat_history", mode="before")(normalize_legacy_history)
 
 class FlowchartResponse(BaseModel):
-    updated_plan_json: Optional[str] = None
+    # The plan object itself (not a JSON-encoded string), serialized once by orjson
+    updated_plan_json: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+class GeminiReply(BaseModel):
+    # JSON object the model is prompted to return, parsed and validated in one pass
+    reply_text: str = ""
     error: Optional[str] = None
+    updated_plan_json: Optional[Dict[str, Any]] = None
 
 # --- UPDATED PROMPT: CONTEXT AWARENESS ADDED ---
 CONVERSATIONAL_SYSTEM_PROMPT = """
@@ -369,181 +500,959 @@ Return ONLY a JSON object:
 FLOWCHART_SYSTEM_PROMPT = """
 You are "EventFlow," an expert event planning system.
 Analyze the conversation and create a JSON event plan.
+
+If information is missing, suggest reasonable defaults based on the Event Type.
+
+REQUIRED JSON STRUCTURE:
+{
+  "reply_text": "Here is your plan...",
+  "updated_plan_json": {
+    "event_plan": [
+      { "step": 1, "task": "...", "details": "...", "reasoning": "..." }
+    ],
+    "required_vendors": ["..."],
+    "suggestions": "..."
+  }
+}
+"""
+
+# Keywords for validate_information_sufficiency. Messages are tokenized and
+# checked by set membership, so "may" no longer matches "dismay" and a lone "k"
+# only counts as a token of its own (e.g. "5k" -> "5", "k").
+_EVENT_KEYWORDS = frozenset({
+    "event", "events", "party", "parties", "wedding", "weddings", "birthday", "birthdays", "bash", "bashes",
+    "ceremony", "ceremonies", "meeting", "meetings", "corporate", "get-together", "get-togethers",
+    "dinner", "dinners", "lunch", "lunches", "anniversary", "anniversaries",
+})
+_DATE_KEYWORDS = frozenset({
+    "jan", "january", "feb", "february", "mar", "march", "apr", "april", "may", "jun", "june",
+    "jul", "july", "aug", "august", "sep", "sept", "september", "oct", "october", "nov", "november",
+    "dec", "december", "month", "months", "year", "years", "week", "weeks", "weekend", "weekends",
+    "night", "nights", "day", "days", "today", "tonight", "tomorrow",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "mondays", "tuesdays", "wednesdays", "thursdays", "fridays", "saturdays", "sundays",
+})
+_GUEST_KEYWORDS = frozenset({
+    "guest", "guests", "people", "pax", "friend", "friends", "family", "families", "crowd", "attendee", "attendees",
+})
+_BUDGET_KEYWORDS = frozenset({
+    "budget", "budgets", "cost", "costs", "price", "prices", "dollar", "dollars", "usd", "rupees", "rs", "k", "$",
+    "cheap", "expensive", "afford", "spending",
+})
+_VENUE_KEYWORDS = frozenset({
+    "venue", "venues", "place", "places", "hall", "halls", "hotel", "hotels", "resort", "resorts",
+    "home", "homes", "house", "houses", "garden", "gardens", "outdoor", "outdoors", "indoor", "indoors",
+    "restaurant", "restaurants", "cafe", "cafes", "beach", "beaches", "bar", "bars",
+})
+
+# Words (hyphenated ones kept whole, e.g. "get-together"), "$", or runs of digits
+_TOKEN_RE = re.compile(r"[a-z]+(?:-[a-z]+)*|\$|\d+")
+
+# (missing item label, keywords, whether any number satisfies it) in report order.
+# Date and guest count are relaxed: a direct number (e.g. "12/05", "80") counts.
+_INFORMATION_CATEGORIES = (
+    ("event type", _EVENT_KEYWORDS, False),
+    ("date/time", _DATE_KEYWORDS, True),
+    ("guest count", _GUEST_KEYWORDS, True),
+    ("budget", _BUDGET_KEYWORDS, False),
+    ("venue", _VENUE_KEYWORDS, False),
+)
+
+# Every keyword mapped to a bitmask of the categories it satisfies (bit i is
+# _INFORMATION_CATEGORIES[i]), so a message is scanned with one dict lookup
+# per token instead of one set test per category
+_KEYWORD_MASKS: Dict[str, int] = {}
+for _bit, (_, _keywords, _) in enumerate(_INFORMATION_CATEGORIES):
+    for _keyword in _keywords:
+        _KEYWORD_MASKS[_keyword] = _KEYWORD_MASKS.get(_keyword, 0) | 1 << _bit
+_NUMBER_MASK = sum(1 << bit for bit, (_, _, numbers_count) in enumerate(_INFORMATION_CATEGORIES) if numbers_count)
+_ALL_CATEGORIES_MASK = (1 << len(_INFORMATION_CATEGORIES)) - 1
+
+# Categories a plan can't be generated without; the rest the AI can estimate
+_CRITICAL_ITEMS = frozenset({"event type"})
+_CRITICAL_MASK = sum(1 << bit for bit, (label, _, _) in enumerate(_INFORMATION_CATEGORIES) if label in _CRITICAL_ITEMS)
+
+SUMMARY_SYSTEM_PROMPT = """
+You summarize event planning conversations for "EventFlow."
+Keep every concrete detail the user gave (event type, date, guest count, budget,
+venue, style, names, constraints) and any decisions already made. Drop small talk.
+Reply with plain text only, under 200 words.
 """
 
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
-def convert_chat_history_to_gemini_format(chat_history: Dict[str, str]) -> List[Dict[str, Any]]:
-    messages = []
-    # Sorting keys is crucial to keep conversation in order
-    for key in sorted(chat_history.keys()):
-        role = "model" if "ai" in key.lower() else "user"
-        text = chat_history[key]
-        if text and text.strip():
-            messages.append({
-                "role": role,
-                "parts": [{"text": text}]
-            })
-    return messages
-
-def validate_information_sufficiency(chat_history: Dict[str, str]) -> tuple[bool, List[str]]:
+def estimate_tokens(text: str) -> int:
+    # Rough heuristic (~4 characters per token); good enough for budgeting
+    return len(text) // 4
+
+def has_text(message: ChatMessage) -> bool:
+    return any(part.text.strip() for part in message.parts)
+
+def to_gemini_content(message: ChatMessage) -> Dict[str, Any]:
+    # Gemini rejects empty text parts, so blank ones are dropped individually
+    return {"role": message.role, "parts": [{"text": part.text} for part in message.parts if part.text.strip()]}
+
+def convert_chat_history_to_gemini_format(chat_history: List[ChatMessage]) -> List[Dict[str, Any]]:
+    # History is append-only and kept in the order the client sent it, so the
+    # request prefix stays byte-identical between turns (Gemini implicit caching)
+    return [to_gemini_content(message) for message in chat_history if has_text(message)]
+
+def extend_history_hash(history_key: int, message: ChatMessage) -> int:
+    """
+    Rolling hash of a conversation: fold in one message at a time so a
+    session can update its key on append instead of rehashing everything.
+    """
+    return hash((history_key, message.role, tuple(part.text for part in message.parts)))
+
+def tokenize(text: str) -> set[str]:
+    tokens = set(_TOKEN_RE.findall(text.lower()))
+    for token in [token for token in tokens if "-" in token]:
+        tokens.update(token.split("-"))
+    return tokens
+
+@functools.lru_cache(maxsize=4096)
+def text_information_mask(text: str) -> int:
+    """
+    Keyword scan behind validate_information_sufficiency: the bitmask of
+    categories one message text covers. Cached on the text, so clients that
+    resend their full history only pay for the messages that are new.
+    """
+    found = 0
+    for token in tokenize(text):
+        found |= _NUMBER_MASK if token.isdigit() else _KEYWORD_MASKS.get(token, 0)
+    return found
+
+def validate_information_sufficiency(session: "ChatSession") -> tuple[bool, List[str]]:
     """
     Analyze chat history to determine if there's enough information for flowchart generation.
+    The session keeps its category mask up to date as messages are appended.
     """
-    # 1. Debugging: Print what the server actually sees
-    full_conversation = " ".join(chat_history.values()).lower()
-    print(f"\n[DEBUG] analyzing conversation context: {full_conversation}\n")
-    
-    missing_items = []
-    
-    # 2. Relaxed Keywords (Broader matching)
-    
-    # Event Type
-    event_keywords = ["event", "party", "wedding", "birthday", "bash", "ceremony", "meeting", "corporate", "get-together", "dinner", "lunch", "anniversary"]
-    if not any(keyword in full_conversation for keyword in event_keywords):
-        missing_items.append("event type")
-    
-    # Date (Relaxed: checks for months, days, or simple time words)
-    date_keywords = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec", "month", "year", "week", "tomorrow", "weekend", "night", "day", "2024", "2025"]
-    if not any(keyword in full_conversation for keyword in date_keywords):
-        # Double check for direct numbers like "12/05"
-        if not any(char.isdigit() for char in full_conversation):
-            missing_items.append("date/time")
-    
-    # Guest Count (Relaxed: looks for digits associated with people words OR just digits if context implies)
-    guest_keywords = ["guest", "people", "pax", "friends", "family", "crowd", "attendee"]
-    has_guest_word = any(keyword in full_conversation for keyword in guest_keywords)
-    has_number = any(char.isdigit() for char in full_conversation)
+    missing_items = [
+        label for bit, (label, _, _) in enumerate(_INFORMATION_CATEGORIES) if not session.information_mask & 1 << bit
+    ]
+
+    # Only the critical items (event type) are required; the AI estimates the rest
+    if session.information_mask & _CRITICAL_MASK != _CRITICAL_MASK:
+        return False, missing_items
+    return True, missing_items
+
+@functools.lru_cache(maxsize=16)
+def static_payload_prefix(prompt: str) -> bytes:
+    # Everything but "contents", serialized once and left open (no closing brace).
+    # The system prompt sits ahead of the conversation, so the request prefix
+    # stays byte-stable for Gemini's implicit caching and only the tail changes.
+    static = {
+        "systemInstruction": {"parts": [{"text": prompt}]},
+        "generationConfig": {"responseMimeType": "application/json"},
+    }
+    return orjson.dumps(static)[:-1]
+
+def encode_payload(prompt: str, gemini_messages: List[Dict[str, Any]]) -> bytes:
+    """
+    Serialized generateContent body: the static prefix for `prompt` plus the
+    per-request contents, the only part encoded on every call.
+    """
+    prefix = static_payload_prefix(prompt)
+    return prefix + b',"contents":' + orjson.dumps(gemini_messages) + b"}"
+
+def build_conversational_payload(contents: List[Dict[str, Any]], current_text: str) -> bytes:
+    gemini_messages = contents + [{
+        "role": "user",
+        "parts": [{"text": current_text}]
+    }]
     
-    if not (has_guest_word or has_number):
-        missing_items.append("guest count")
+    return encode_payload(CONVERSATIONAL_SYSTEM_PROMPT, gemini_messages)
+
+def build_flowchart_payload(contents: List[Dict[str, Any]], missing_items: List[str]) -> bytes:
+    # --- FORCE GENERATION IF SUFFICIENT ---
+    # Even if 1-2 minor things are missing, we tell AI to "Assume or Estimate"
+    prompt_modifier = ""
+    if missing_items:
+        prompt_modifier = f"Note: Information about {', '.join(missing_items)} is missing."
+
+    # Static instructions live in FLOWCHART_SYSTEM_PROMPT; only per-request
+    # details go in this final turn so everything before it stays cacheable
+    final_prompt = f"Create a detailed JSON event plan based on the conversation.\n{prompt_modifier}".strip()
     
-    # Budget (Relaxed)
-    budget_keywords = ["budget", "cost", "price", "dollar", "usd", "rupees", "rs", "k", "$", "cheap", "expensive", "afford", "spending"]
-    if not any(keyword in full_conversation for keyword in budget_keywords):
-         # If there is a generic number like "5000" it might be budget, but hard to tell without symbol. 
-         # We will assume missing if no keyword found.
-        missing_items.append("budget")
+    gemini_messages = contents + [{
+        "role": "user",
+        "parts": [{"text": final_prompt}]
+    }]
 
-    # Venue (Relaxed)
-    venue_keywords = ["venue", "place", "hall", "hotel", "resort", "home", "house", "garden", "outdoor", "indoor", "restaurant", "cafe", "beach", "bar"]
-    if not any(keyword in full_conversation for keyword in venue_keywords):
-        missing_items.append("venue")
+    return encode_payload(FLOWCHART_SYSTEM_PROMPT, gemini_messages)
 
-    print(f"[DEBUG] Missing items detected: {missing_items}")
+def insufficient_information_error(missing_items: List[str]) -> str:
+    return f"I still need a bit more info: {', '.join(missing_items)}"
 
-    # 3. Lower Threshold: Allow generation if only 1 or 2 non-critical items are vague
-    # If we have at least Event Type and (Date OR Guests), we try to generate.
-    critical_missing = [item for item in missing_items if item in ["event type"]]
+def to_flowchart_response(ai_reply: GeminiReply) -> Dict[str, Any]:
+    """
+    Shape a plan as a FlowchartResponse body. Built as a plain dict so it can go
+    straight to OrjsonResponse without another round of model validation.
+    """
+    if ai_reply.error:
+        return {"updated_plan_json": None, "error": ai_reply.error}
+        
+    if ai_reply.updated_plan_json is not None:
+        return {"updated_plan_json": ai_reply.updated_plan_json, "error": None}
     
-    if len(critical_missing) > 0:
-        return False, missing_items
+    return {"updated_plan_json": None, "error": "Failed to generate plan."}
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    frame = f"event: {event}\n" if event else ""
+    return f"{frame}data: {orjson.dumps(data).decode()}\n\n"
+
+# ============================================================================
+# SESSIONS
+# ============================================================================
+
+@dataclass
+class ChatSession:
+    """
+    A conversation with its Gemini-format contents and rolling hash kept up
+    to date on every append, so a turn never rebuilds them from scratch.
+    """
+    messages: List[ChatMessage] = field(default_factory=list)
+    contents: List[Dict[str, Any]] = field(default_factory=list)
+    history_key: int = 0
+    # prefix_keys[i] is the rolling hash of the first i + 1 messages
+    prefix_keys: List[int] = field(default_factory=list)
+    token_estimate: int = 0
+    # Categories from _INFORMATION_CATEGORIES seen so far, one bit each; the
+    # user mask counts only what the user said, not the model's questions
+    information_mask: int = 0
+    user_information_mask: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+
+    @classmethod
+    def from_history(cls, chat_history: List[ChatMessage]) -> "ChatSession":
+        session = cls()
+        for message in chat_history:
+            session.append(message)
+        return session
+
+    def append(self, message: ChatMessage):
+        if not has_text(message):
+            return
+        self.messages.append(message)
+        self.contents.append(to_gemini_content(message))
+        self.history_key = extend_history_hash(self.history_key, message)
+        self.prefix_keys.append(self.history_key)
+        self.token_estimate += sum(estimate_tokens(part.text) for part in message.parts)
+        message_mask = 0
+        for part in message.parts:
+            message_mask |= text_information_mask(part.text)
+        self.information_mask |= message_mask
+        if message.role == "user":
+            self.user_information_mask |= message_mask
+
+    def append_turn(self, user_text: str, reply_text: str):
+        self.append(ChatMessage(role="user", parts=[ChatPart(text=user_text)]))
+        self.append(ChatMessage(role="model", parts=[ChatPart(text=reply_text)]))
+
+# In-memory LRU of live sessions (per worker process)
+_sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+def get_session(session_id: str) -> Optional[ChatSession]:
+    session = _sessions.get(session_id)
+    if session is None:
+        return None
+    if time.monotonic() - session.last_used > SESSION_TTL_SECONDS:
+        del _sessions[session_id]
+        return None
+    session.last_used = time.monotonic()
+    _sessions.move_to_end(session_id)
+    return session
+
+def save_session(session_id: str, session: ChatSession):
+    _sessions[session_id] = session
+    _sessions.move_to_end(session_id)
+    while len(_sessions) > SESSION_CACHE_SIZE:
+        _sessions.popitem(last=False)
+
+async def load_history(chat_history: List[ChatMessage]) -> ChatSession:
+    if (
+        len(chat_history) > THREAD_OFFLOAD_MESSAGES
+        or sum(len(part.text) for message in chat_history for part in message.parts) > THREAD_OFFLOAD_TOKENS * 4
+    ):
+        return await asyncio.to_thread(ChatSession.from_history, chat_history)
+    return ChatSession.from_history(chat_history)
+
+async def resolve_session(chat_history: List[ChatMessage], session_id: Optional[str], create: bool) -> tuple[ChatSession, Optional[str]]:
+    """
+    Return the conversation for a request and the session id to report back.
+    A live session wins over any chat_history sent alongside it. An unknown or
+    expired id is re-seeded from chat_history; without one it is a 404, since
+    sessions are per worker process and the client must resend its history
+    rather than silently start over. With no id, a new session is
+    opened only when `create` is set and the client sent no history (its first
+    turn); clients that send full history every turn stay stateless.
+    """
+    if session_id:
+        session = get_session(session_id)
+        if session is None:
+            if not chat_history:
+                raise HTTPException(status_code=404, detail="Unknown or expired session_id; resend chat_history")
+            session = await load_history(chat_history)
+            save_session(session_id, session)
+        return session, session_id
     
-    # If we have the event type, we allow generation even if budget is missing (AI can estimate)
-    return True, missing_items
+    session = await load_history(chat_history)
+    if create and not chat_history:
+        session_id = secrets.token_urlsafe(16)
+        save_session(session_id, session)
+    return session, session_id
 
 # ============================================================================
 # API FUNCTIONS
 # ============================================================================
 
-async def get_conversational_response(chat_history: Dict[str, str], current_text: str) -> Dict[str, Any]:
+def ensure_api_key():
     if not GEMINI_API_KEY:
         raise HTTPException(status_code=500, detail="GEMINI_API_KEY missing")
+
+async def post_json(url: str, payload: Union[Dict[str, Any], bytes]) -> httpx.Response:
+    """
+    POST a JSON payload to Gemini, retrying connection failures and 5xx
+    responses. The last 5xx response is returned rather than raised; transport
+    errors that are out of retries become a 504 (timeouts) or 502.
+    """
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            response = await app.state.http.post(url, content=body, headers=JSON_HEADERS)
+        except httpx.HTTPError as e:
+            retryable = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+            if not retryable or attempt == GEMINI_MAX_RETRIES:
+                print(f"[ERROR] Gemini request failed: {type(e).__name__}")
+                if isinstance(e, httpx.TimeoutException):
+                    raise HTTPException(status_code=504, detail="Gemini API timed out")
+                raise HTTPException(status_code=502, detail="Gemini API request failed")
+        else:
+            if response.status_code < 500 or attempt == GEMINI_MAX_RETRIES:
+                return response
+        await asyncio.sleep(GEMINI_RETRY_BACKOFF * 2 ** attempt)
+
+def gemini_text(response: httpx.Response) -> str:
+    """
+    Extract the first candidate's text from a generateContent response.
+    """
+    if response.is_error:
+        print(f"[ERROR] Gemini API error: {response.status_code} - {response.text}")
+        raise HTTPException(status_code=502, detail=f"Gemini API error: {response.status_code}")
+    try:
+        return orjson.loads(response.content)["candidates"][0]["content"]["parts"][0]["text"]
+    except (ValueError, KeyError, IndexError) as e:
+        print(f"[ERROR] Unexpected Gemini response: {e}")
+        raise HTTPException(status_code=502, detail="Gemini returned no content")
+
+def parse_gemini_reply(text: str) -> GeminiReply:
+    # model_validate_json parses with pydantic-core's jiter straight into the
+    # model; there is no intermediate json.loads dict to build and re-validate
+    try:
+        return GeminiReply.model_validate_json(text)
+    except ValidationError as e:
+        print(f"[ERROR] Invalid Gemini reply: {e}")
+        raise HTTPException(status_code=502, detail="Gemini returned an invalid reply")
+
+async def get_conversational_response(contents: List[Dict[str, Any]], current_text: str) -> GeminiReply:
+    ensure_api_key()
     
-    gemini_messages = convert_chat_history_to_gemini_format(chat_history)
+    payload = build_conversational_payload(contents, current_text)
     
-    gemini_messages.append({
-        "role": "user",
-        "parts": [{"text": current_text}]
-    })
+    response = await post_json(API_URL, payload)
+    return parse_gemini_reply(gemini_text(response))
+
+async def prepare_flowchart_payload(session: ChatSession) -> tuple[Optional[bytes], List[str]]:
+    """
+    Check sufficiency (constant time off the session's running mask) before
+    compacting the history, which may itself wait on Gemini. Returns
+    (None, missing_items) when there isn't enough information to build a plan.
+    """
+    is_sufficient, missing_items = validate_information_sufficiency(session)
+    if not is_sufficient:
+        return None, missing_items
+    return build_flowchart_payload(await compact_contents(session), missing_items), missing_items
+
+async def get_flowchart_response(session: ChatSession) -> GeminiReply:
+    ensure_api_key()
+    
+    payload, missing_items = await prepare_flowchart_payload(session)
+    if payload is None:
+        return GeminiReply(error=insufficient_information_error(missing_items))
     
+    response = await post_json(API_URL, payload)
+    return parse_gemini_reply(gemini_text(response))
+
+async def stream_gemini_text(payload: bytes) -> AsyncIterator[str]:
+    """
+    Yield text deltas from Gemini's streamGenerateContent SSE endpoint as they arrive.
+    """
+    async with app.state.http.stream("POST", STREAM_API_URL, content=payload, headers=JSON_HEADERS) as response:
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = orjson.loads(line[len("data:"):])
+            for candidate in chunk.get("candidates", [])[:1]:
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
+
+def plan_step_events() -> Callable[[str], List[str]]:
+    """
+    Build a progress hook for stream_events that partially parses the reply
+    so far and returns a `step` event for each event_plan step once it is
+    complete, letting the UI render the plan as it is generated.
+    """
+    emitted = 0
+
+    def on_text(text: str) -> List[str]:
+        nonlocal emitted
+        try:
+            reply = from_json(text, allow_partial=True)
+        except ValueError:
+            return []
+        plan = reply.get("updated_plan_json") if isinstance(reply, dict) else None
+        steps = plan.get("event_plan") if isinstance(plan, dict) else None
+        if not isinstance(steps, list):
+            return []
+        # The last step parsed may still be missing fields, until either the
+        # next step or the key after event_plan has started
+        complete = len(steps) if list(plan)[-1] != "event_plan" else len(steps) - 1
+        events = [sse_event(step, event="step") for step in steps[emitted:complete]]
+        emitted = max(emitted, complete)
+        return events
+
+    return on_text
+
+async def stream_events(
+    payload: bytes,
+    finalize: Callable[[GeminiReply], Dict[str, Any]],
+    progress: Optional[Callable[[str], List[str]]] = None,
+) -> AsyncIterator[str]:
+    """
+    Forward Gemini deltas as `data: {"token": ...}` frames, then one `done`
+    event carrying the same body the non-streaming endpoint would return.
+    `progress`, if given, is called with the text so far and may add frames.
+    """
+    chunks = []
+    try:
+        async for delta in stream_gemini_text(payload):
+            chunks.append(delta)
+            yield sse_event({"token": delta})
+            # A step can only have completed if this delta closed an object
+            if progress is not None and "}" in delta:
+                for frame in progress("".join(chunks)):
+                    yield frame
+        yield sse_event(finalize(GeminiReply.model_validate_json("".join(chunks))), event="done")
+    except httpx.HTTPStatusError as e:
+        yield sse_event({"error": f"Gemini API error: {e.response.status_code}"}, event="error")
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"[ERROR] Streaming failed: {e}")
+        yield sse_event({"error": "Failed to generate response."}, event="error")
+
+# ============================================================================
+# HISTORY COMPACTION
+# ============================================================================
+
+# Summaries keyed by the rolling hash of the history prefix they cover
+_summaries: "OrderedDict[int, str]" = OrderedDict()
+
+def summary_turns(summary: str) -> List[Dict[str, Any]]:
+    return [
+        {"role": "user", "parts": [{"text": f"Summary of our earlier conversation:\n{summary}"}]},
+        {"role": "model", "parts": [{"text": "Got it."}]},
+    ]
+
+async def summarize_contents(contents: List[Dict[str, Any]]) -> str:
     payload = {
-        "systemInstruction": {"parts": [{"text": CONVERSATIONAL_SYSTEM_PROMPT}]},
-        "contents": gemini_messages,
-        "generationConfig": {"responseMimeType": "application/json"}
+        "systemInstruction": {"parts": [{"text": SUMMARY_SYSTEM_PROMPT}]},
+        "contents": contents + [{"role": "user", "parts": [{"text": "Summarize the conversation so far."}]}],
     }
+    response = await post_json(API_URL, payload)
+    return truncate_text(gemini_text(response).strip())
+
+async def get_history_summary(session: ChatSession, cut: int) -> str:
+    """
+    Summary of session.contents[:cut]. When the summary of the previous block
+    is cached, only that summary plus the newest block is sent to Gemini.
+    """
+    key = session.prefix_keys[cut - 1]
+    summary = _summaries.get(key)
+    if summary is not None:
+        _summaries.move_to_end(key)
+        return summary
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(API_URL, json=payload)
-        result = response.json()
-        # Safety check for empty responses
-        try:
-            return json.loads(result["candidates"][0]["content"]["parts"][0]["text"])
-        except:
-            return {"reply_text": "Could you please repeat that?"}
+    previous_cut = cut - COMPACTION_KEEP_RECENT
+    previous = _summaries.get(session.prefix_keys[previous_cut - 1]) if previous_cut > 0 else None
+    if previous is not None:
+        contents = summary_turns(previous) + session.contents[previous_cut:cut]
+    else:
+        contents = session.contents[:cut]
+    
+    summary = await single_flight(("summary", key), lambda: summarize_contents(contents))
+    _summaries[key] = summary
+    if len(_summaries) > SUMMARY_CACHE_SIZE:
+        _summaries.popitem(last=False)
+    return summary
 
-async def get_flowchart_response(chat_history: Dict[str, str]) -> Dict[str, Any]:
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="GEMINI_API_KEY missing")
+async def compact_contents(session: ChatSession) -> List[Dict[str, Any]]:
+    """
+    Gemini contents for a session, with older turns collapsed into a summary
+    once the history grows past MAX_HISTORY_TOKENS or HISTORY_WINDOW messages.
+    """
+    count = len(session.contents)
     
-    is_sufficient, missing_items = validate_information_sufficiency(chat_history)
+    # Cuts land on multiples of COMPACTION_KEEP_RECENT so the summarized range
+    # (and its cached summary) only moves every few turns, keeping the prefix stable
+    window_cut = 0
+    if count > HISTORY_WINDOW:
+        window_cut = -(-(count - HISTORY_WINDOW) // COMPACTION_KEEP_RECENT) * COMPACTION_KEEP_RECENT
+    token_cut = 0
+    if session.token_estimate > MAX_HISTORY_TOKENS:
+        token_cut = (count - COMPACTION_KEEP_RECENT) // COMPACTION_KEEP_RECENT * COMPACTION_KEEP_RECENT
     
-    # --- FORCE GENERATION IF SUFFICIENT ---
-    # Even if 1-2 minor things are missing, we tell AI to "Assume or Estimate"
-    prompt_modifier = ""
-    if not is_sufficient:
-        return {"error": f"I still need a bit more info: {', '.join(missing_items)}"}
-    elif missing_items:
-        prompt_modifier = f"Note: Information about {', '.join(missing_items)} is missing. Please suggest reasonable defaults based on the Event Type."
-
-    gemini_messages = convert_chat_history_to_gemini_format(chat_history)
-    
-    final_prompt = f"""
-    Create a detailed JSON event plan based on the conversation.
-    {prompt_modifier}
-    
-    REQUIRED JSON STRUCTURE:
-    {{
-      "reply_text": "Here is your plan...",
-      "updated_plan_json": {{
-        "event_plan": [
-          {{ "step": 1, "task": "...", "details": "...", "reasoning": "..." }}
-        ],
-        "required_vendors": ["..."],
-        "suggestions": "..."
-      }}
-    }}
-    """
-    
-    gemini_messages.append({
-        "role": "user",
-        "parts": [{"text": final_prompt}]
-    })
+    cut = max(window_cut, token_cut)
+    if cut <= 0:
+        return session.contents
+    
+    try:
+        summary = await get_history_summary(session, cut)
+    except (httpx.HTTPError, HTTPException) as e:
+        # Without a summary, keep within the window and lose the oldest turns
+        print(f"[ERROR] History summarization failed: {e}")
+        return session.contents[window_cut:]
+    return summary_turns(summary) + session.contents[cut:]
 
-    payload = {
-        "systemInstruction": {"parts": [{"text": FLOWCHART_SYSTEM_PROMPT}]},
-        "contents": gemini_messages,
-        "generationConfig": {"responseMimeType": "application/json"}
-    }
+# ============================================================================
+# RESPONSE CACHE
+# ============================================================================
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks: set = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Gemini calls currently running, keyed by request; identical concurrent requests share one
+_inflight: Dict[Hashable, asyncio.Task] = {}
+
+def _forget_inflight(key: Hashable, task: asyncio.Task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # mark retrieved; callers that are still waiting re-raise it
+
+async def single_flight(key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run call() once per key at a time; concurrent callers with the same key
+    await the same result instead of issuing their own request. The call runs
+    as its own task, so no caller (not even the first) disconnecting cancels
+    it for the others.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(call())
+        _inflight[key] = task
+        task.add_done_callback(functools.partial(_forget_inflight, key))
+    return await asyncio.shield(task)
+
+class SemanticCache:
+    """
+    Near-duplicate reply cache. Unit-length embeddings are stacked in a
+    fixed-size ring-buffer matrix, so a lookup is one matrix-vector product;
+    entries only match within the same conversation state and expire after a TTL.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        # Allocated on first insert, once the embedding size is known
+        self._matrix: Optional[np.ndarray] = None
+        self._keys = np.zeros(max_entries, dtype=np.int64)
+        self._expires = np.zeros(max_entries)  # 0 marks an empty slot
+        self._replies: List[Optional[str]] = [None] * max_entries
+        self._next = 0
+
+    def _live(self, history_key: int) -> np.ndarray:
+        return (self._keys == history_key) & (self._expires > time.monotonic())
+
+    def has_entries(self, history_key: int) -> bool:
+        return bool(self._live(history_key).any())
+
+    def lookup(self, history_key: int, vector: np.ndarray) -> Optional[str]:
+        if self._matrix is None:
+            return None
+        live = self._live(history_key)
+        if not live.any():
+            return None
+        scores = np.where(live, self._matrix @ vector, -1.0)
+        best = int(scores.argmax())
+        return self._replies[best] if scores[best] >= self.threshold else None
+
+    def add(self, history_key: int, vector: np.ndarray, reply: str):
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        slot = self._next
+        self._matrix[slot] = vector
+        self._keys[slot] = history_key
+        self._expires[slot] = time.monotonic() + self.ttl_seconds
+        self._replies[slot] = reply
+        self._next = (slot + 1) % self.max_entries
+
+_exact_replies: "OrderedDict[tuple[int, str], str]" = OrderedDict()
+_semantic_replies = SemanticCache(SEMANTIC_CACHE_SIZE, CACHE_TTL_SECONDS, SEMANTIC_THRESHOLD)
+
+def normalize_message(text: str) -> str:
+    return " ".join(text.lower().split())
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    payload = {"content": {"parts": [{"text": text}]}}
+    try:
+        response = await post_json(EMBED_API_URL, payload)
+        if response.is_error:
+            raise ValueError(f"status {response.status_code}")
+        values = orjson.loads(response.content)["embedding"]["values"]
+    except (HTTPException, KeyError, ValueError) as e:
+        # The semantic tier is best-effort; fall through to Gemini
+        print(f"[ERROR] Embedding failed: {e}")
+        return None
+    vector = np.asarray(values, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def semantic_eligible(history_key: int, message: str) -> bool:
+    # Near-duplicates only recur for opening messages ("hi" / "hello" with no
+    # history, rolling hash 0); deeper in a conversation the history key never
+    # repeats, so embedding those messages would cost a call for no chance of a hit
+    return history_key == 0 and len(message) <= SEMANTIC_MAX_CHARS
+
+async def find_cached_reply(history_key: int, current_text: str) -> tuple[Optional[str], Optional[np.ndarray]]:
+    """
+    Look up a reply for this message at this point in the conversation.
+    Returns (reply, embedding); the embedding is handed back on a miss so
+    store_cached_reply doesn't have to compute it again.
+    """
+    key = (history_key, normalize_message(current_text))
+    reply = _exact_replies.get(key)
+    if reply is not None:
+        _exact_replies.move_to_end(key)
+        return reply, None
+    
+    if not semantic_eligible(history_key, key[1]) or not _semantic_replies.has_entries(history_key):
+        return None, None
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(API_URL, json=payload)
-        result = response.json()
-        return json.loads(result["candidates"][0]["content"]["parts"][0]["text"])
+    vector = await embed_text(key[1])
+    if vector is None:
+        return None, None
+    return _semantic_replies.lookup(history_key, vector), vector
+
+async def store_cached_reply(history_key: int, current_text: str, reply: str, vector: Optional[np.ndarray]):
+    key = (history_key, normalize_message(current_text))
+    _exact_replies[key] = reply
+    _exact_replies.move_to_end(key)
+    if len(_exact_replies) > EXACT_CACHE_SIZE:
+        _exact_replies.popitem(last=False)
+    
+    if semantic_eligible(history_key, key[1]):
+        if vector is None:
+            vector = await embed_text(key[1])
+        if vector is not None:
+            _semantic_replies.add(history_key, vector, reply)
+
+# Generated plans keyed by flowchart_cache_key, with their expiry time
+FlowchartKey = tuple[str, ...]
+_flowchart_replies: "OrderedDict[FlowchartKey, tuple[float, GeminiReply]]" = OrderedDict()
+
+def flowchart_cache_key(session: ChatSession) -> FlowchartKey:
+    """
+    Canonical form of what the user told us: each of their messages, in order,
+    reduced to its lowercase words and numbers. Histories that differ only in
+    the model's wording, casing or punctuation map to the same plan, while
+    word order (which number goes with which detail) is kept.
+    """
+    return tuple(
+        " ".join(_TOKEN_RE.findall(part.text.lower()))
+        for message in session.messages
+        if message.role == "user"
+        for part in message.parts
+    )
+
+def find_cached_flowchart(key: FlowchartKey) -> Optional[GeminiReply]:
+    entry = _flowchart_replies.get(key)
+    if entry is None:
+        return None
+    expires, ai_reply = entry
+    if expires <= time.monotonic():
+        del _flowchart_replies[key]
+        return None
+    _flowchart_replies.move_to_end(key)
+    return ai_reply
+
+def store_cached_flowchart(key: FlowchartKey, ai_reply: GeminiReply):
+    # Only real plans are worth reusing; errors depend on the moment
+    if ai_reply.error or ai_reply.updated_plan_json is None:
+        return
+    _flowchart_replies[key] = (time.monotonic() + CACHE_TTL_SECONDS, ai_reply)
+    _flowchart_replies.move_to_end(key)
+    if len(_flowchart_replies) > FLOWCHART_CACHE_SIZE:
+        _flowchart_replies.popitem(last=False)
+
+# ============================================================================
+# SPECULATIVE FLOWCHART PREWARM
+# ============================================================================
+
+async def prewarm_flowchart(state, cache_key: FlowchartKey, session: ChatSession) -> Optional[GeminiReply]:
+    try:
+        async with state.prewarm_slots:
+            ai_reply = await single_flight(
+                ("flowchart", session.history_key),
+                lambda: get_flowchart_response(session),
+            )
+    except Exception as e:
+        # Speculative; /generate-flowchart falls back to a live call
+        print(f"[ERROR] Flowchart prewarm failed: {e}")
+        return None
+    finally:
+        state.prewarm.pop(cache_key, None)
+    store_cached_flowchart(cache_key, ai_reply)
+    return ai_reply
+
+def schedule_flowchart_prewarm(state, session: ChatSession, previous_user_mask: int):
+    """
+    On the turn where the user's own messages first cover every detail on the
+    checklist, start generating the plan in the background so a following
+    /generate-flowchart finds it done or in flight. Firing only on that turn
+    (later turns change the cache key) keeps it to one speculative call per
+    conversation. Skipped while every prewarm slot is busy.
+    """
+    if (
+        not GEMINI_API_KEY
+        or previous_user_mask == _ALL_CATEGORIES_MASK
+        or session.user_information_mask != _ALL_CATEGORIES_MASK
+        or state.prewarm_slots.locked()
+    ):
+        return
+    cache_key = flowchart_cache_key(session)
+    if cache_key in state.prewarm or find_cached_flowchart(cache_key) is not None:
+        return
+    # Snapshot, so later turns on a live session don't leak into this plan
+    snapshot = replace(
+        session,
+        messages=list(session.messages),
+        contents=list(session.contents),
+        prefix_keys=list(session.prefix_keys),
+    )
+    task = run_in_background(prewarm_flowchart(state, cache_key, snapshot))
+    state.prewarm[cache_key] = (time.monotonic(), task)
+
+async def join_flowchart_prewarm(state, cache_key: FlowchartKey) -> Optional[GeminiReply]:
+    entry = state.prewarm.get(cache_key)
+    if entry is None:
+        return None
+    task = entry[1]
+    try:
+        # shield: a disconnecting client must not cancel the shared prewarm
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # The prewarm itself was evicted (or shut down): fall back to a live
+        # call. A cancellation of this request still propagates.
+        if task.cancelled() and not asyncio.current_task().cancelling():
+            return None
+        raise
+
+async def evict_flowchart_prewarms(state):
+    """Lifespan task: cancel prewarms that have been running longer than the TTL."""
+    while True:
+        await asyncio.sleep(PREWARM_TTL_SECONDS / 2)
+        cutoff = time.monotonic() - PREWARM_TTL_SECONDS
+        for cache_key, (started, task) in list(state.prewarm.items()):
+            if started < cutoff:
+                task.cancel()
+                state.prewarm.pop(cache_key, None)
+
+# ============================================================================
+# REQUEST BODIES
+# ============================================================================
+
+RequestModel = TypeVar("RequestModel", bound=BaseModel)
+
+async def read_request(request: Request, model: Type[RequestModel]) -> RequestModel:
+    """
+    Validate a JSON body straight from the raw bytes with pydantic-core,
+    skipping FastAPI's json.loads-then-validate pass over a dict. Invalid
+    bodies still get FastAPI's usual 422 response, and oversized ones a 413
+    before more than MAX_REQUEST_BYTES is buffered.
+    """
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail="Request body too large")
+    # Content-Length can be absent (chunked) or wrong, so count while reading too
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_REQUEST_BYTES:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        chunks.append(chunk)
+    body = b"".join(chunks)
+    try:
+        return model.model_validate_json(body)
+    except ValidationError as e:
+        # Same locations FastAPI reports for a parsed body: ["body", "field", ...]
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        raise RequestValidationError(errors, body=body)
+
+def inline_schema_refs(schema: Any, defs: Dict[str, Any]) -> Any:
+    if isinstance(schema, dict):
+        if "$ref" in schema:
+            return inline_schema_refs(defs[schema["$ref"].rsplit("/", 1)[1]], defs)
+        return {key: inline_schema_refs(value, defs) for key, value in schema.items()}
+    if isinstance(schema, list):
+        return [inline_schema_refs(value, defs) for value in schema]
+    return schema
+
+def request_body_docs(model: Type[BaseModel]) -> Dict[str, Any]:
+    """openapi_extra documenting a body that read_request parses by hand."""
+    schema = model.model_json_schema()
+    schema = inline_schema_refs(schema, schema.pop("$defs", {}))
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": schema}}}}
 
-app = FastAPI(title="EventFlow API", version="2.1")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared HTTP client (app.state.http), opened/closed here so every Gemini call
+    # reuses pooled keep-alive connections instead of a fresh TCP+TLS handshake
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=GEMINI_TIMEOUT,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30),
+    )
+    # Speculative flowchart tasks, keyed by flowchart_cache_key: (started, task)
+    app.state.prewarm = {}
+    app.state.prewarm_slots = asyncio.Semaphore(PREWARM_CONCURRENCY)
+    eviction = asyncio.create_task(evict_flowchart_prewarms(app.state))
+    try:
+        yield
+    finally:
+        for task in [eviction] + [task for _, task in app.state.prewarm.values()]:
+            task.cancel()
+        await asyncio.gather(eviction, return_exceptions=True)
+        app.state.prewarm.clear()
+        await app.state.http.aclose()
+        app.state.http = None
 
-@app.post("/chat", response_model=ConversationalResponse)
-async def chat_endpoint(request: ChatHistoryRequest):
-    ai_data = await get_conversational_response(request.chat_history, request.current_text)
-    return ConversationalResponse(reply_text=ai_data.get("reply_text", "Tell me more."))
+class OrjsonResponse(Response):
+    """
+    JSON response encoded with orjson. Kept local because FastAPI deprecated
+    its own ORJSONResponse.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(title="EventFlow API", version="2.1", lifespan=lifespan, default_response_class=OrjsonResponse)
+# Flowchart plans compress well; short /chat replies fall under minimum_size, and
+# Starlette never buffers text/event-stream responses for compression
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
-@app.post("/generate-flowchart", response_model=FlowchartResponse)
-async def generate_flowchart_endpoint(request: FlowchartRequest):
-    ai_data = await get_flowchart_response(request.chat_history)
+# Response models are documentation only: handlers return OrjsonResponse
+# directly, skipping FastAPI's jsonable_encoder + revalidation pass
+@app.post("/chat", responses={200: {"model": ConversationalResponse}}, openapi_extra=request_body_docs(ChatHistoryRequest))
+async def chat_endpoint(http_request: Request):
+    request = await read_request(http_request, ChatHistoryRequest)
+    session, session_id = await resolve_session(request.chat_history, request.session_id, create=True)
+    history_key = session.history_key
     
-    if "error" in ai_data and ai_data["error"]:
-        return FlowchartResponse(updated_plan_json=None, error=ai_data["error"])
-        
-    if "updated_plan_json" in ai_data:
-        return FlowchartResponse(
-            updated_plan_json=json.dumps(ai_data["updated_plan_json"]), 
-            error=None
+    # Compaction may wait on a summary call, so it runs alongside the cache
+    # lookup but is only awaited on a miss; after a hit it finishes in the
+    # background and leaves its summary cached
+    compaction = run_in_background(compact_contents(session))
+    reply, vector = await find_cached_reply(history_key, request.current_text)
+    if reply is None:
+        contents = await compaction
+        ai_reply = await single_flight(
+            ("chat", history_key, request.current_text),
+            lambda: get_conversational_response(contents, request.current_text),
         )
+        reply = ai_reply.reply_text or "Tell me more."
+        if ai_reply.reply_text:
+            # Embedding the message for the semantic tier shouldn't delay the reply
+            run_in_background(store_cached_reply(history_key, request.current_text, reply, vector))
+    
+    # Skip if a concurrent duplicate request already recorded this turn. A
+    # stateless session is throwaway, but extending it lets the prewarm see this turn
+    if session.history_key == history_key:
+        previous_user_mask = session.user_information_mask
+        session.append_turn(request.current_text, reply)
+        schedule_flowchart_prewarm(app.state, session, previous_user_mask)
+        # Summarize the next block (if this turn made one due) while the user types
+        run_in_background(compact_contents(session))
+    return OrjsonResponse({"reply_text": reply, "session_id": session_id})
+
+@app.post("/generate-flowchart", responses={200: {"model": FlowchartResponse}}, openapi_extra=request_body_docs(FlowchartRequest))
+async def generate_flowchart_endpoint(http_request: Request):
+    request = await read_request(http_request, FlowchartRequest)
+    session, _ = await resolve_session(request.chat_history, request.session_id, create=False)
+    cache_key = flowchart_cache_key(session)
+    ai_reply = find_cached_flowchart(cache_key) or await join_flowchart_prewarm(app.state, cache_key)
+    if ai_reply is None:
+        ai_reply = await single_flight(
+            ("flowchart", session.history_key),
+            lambda: get_flowchart_response(session),
+        )
+        store_cached_flowchart(cache_key, ai_reply)
+    return OrjsonResponse(to_flowchart_response(ai_reply))
+
+@app.post("/chat/stream", openapi_extra=request_body_docs(ChatHistoryRequest))
+async def chat_stream_endpoint(http_request: Request):
+    request = await read_request(http_request, ChatHistoryRequest)
+    ensure_api_key()
+    session, session_id = await resolve_session(request.chat_history, request.session_id, create=True)
+    history_key = session.history_key
+    payload = build_conversational_payload(await compact_contents(session), request.current_text)
+    
+    def finalize(ai_reply: GeminiReply) -> Dict[str, Any]:
+        reply = ai_reply.reply_text or "Tell me more."
+        if session_id and session.history_key == history_key:
+            session.append_turn(request.current_text, reply)
+        return {"reply_text": reply, "session_id": session_id}
+    
+    return StreamingResponse(stream_events(payload, finalize), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/generate-flowchart/stream", openapi_extra=request_body_docs(FlowchartRequest))
+async def generate_flowchart_stream_endpoint(http_request: Request):
+    request = await read_request(http_request, FlowchartRequest)
+    ensure_api_key()
+    session, _ = await resolve_session(request.chat_history, request.session_id, create=False)
+    payload, missing_items = await prepare_flowchart_payload(session)
+    
+    if payload is None:
+        async def insufficient() -> AsyncIterator[str]:
+            yield sse_event({"updated_plan_json": None, "error": insufficient_information_error(missing_items)}, event="done")
+        return StreamingResponse(insufficient(), media_type="text/event-stream", headers=SSE_HEADERS)
     
-    return FlowchartResponse(error="Failed to generate plan.")
+    events = stream_events(payload, to_flowchart_response, plan_step_events())
+    return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
 
 if __name__ == "__main__":
-    uvicorn.run("eventflow_api:app", host="127.0.0.1", port=8000, reload=True)
+    # uvloop + httptools give uvicorn a C event loop and HTTP parser (uvloop has no Windows build)
+    uvicorn.run(
+        "chatbot:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        # Sessions, caches, prewarms and single-flight calls live in this process,
+        # so stay on one worker; scale out only behind sticky (session_id) routing
+        workers=1,
+        reload=False,
+    )